@@ -1,5 +1,9 @@
-from typing import Union, Iterable, Optional, Dict, List, Any, Set
+from typing import Union, Iterable, Optional, Dict, List, Tuple, Any, Set
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+import functools
+import pickle
+import pickletools
 import unicodedata
 import re
 
@@ -24,46 +28,85 @@ def slugify(value):
     return re.sub("[-\s]+", "_", value)
 
 
-def node_lang_is_python(node: docutils.nodes.literal_block) -> bool:
-    # TODO: Improve handling of "default"
-    python_synonyms = {
+# TODO: Improve handling of "default"
+_PYTHON_SYNONYMS = frozenset(
+    {
         "default",
         "python",
         "py",
         "py3",
         "python3",
     }
+)
+
+
+def node_lang_is_python(node: docutils.nodes.literal_block) -> bool:
+    return node.attributes.get("language") in _PYTHON_SYNONYMS
 
-    if "language" not in node.attributes:
-        return False
 
-    return node.attributes["language"] in python_synonyms
+_LEADING_SPACES_RE = re.compile(r" *")
 
 
 def leading_spaces(s: str) -> int:
     """Return the number of spaces at the start of str"""
-    return len(s) - len(s.lstrip(" "))
+    return _LEADING_SPACES_RE.match(s).end()
+
+
+def get_common_indent(lines: Iterable[str]) -> int:
+    """Return the smallest indent of the non-empty lines, or 0 if there are none"""
+    return min((leading_spaces(l) for l in lines if l), default=0)
+
 
+_HIDDEN_MARKER_RE = re.compile(r"\s*//")
 
-def get_common_indent(*lines: str) -> int:
-    return min(leading_spaces(l) for l in lines if l)
 
+def _is_hidden(line: str) -> bool:
+    """Return True if the first non-whitespace characters of line are a hidden marker"""
+    return _HIDDEN_MARKER_RE.match(line) is not None
 
-def whitespaceify_hidden_markers(*lines: str) -> Iterable[str]:
-    """Convert "//" markers at the start of a line to '  '"""
-    for line in lines:
-        if line.strip().startswith("//"):
-            line = line.replace("//", "  ", 1)
-        yield line
 
+def _process_lines(lines: List[str]) -> Tuple[str, str]:
+    """Produce the code to execute and the code to show from the lines of a block
 
-def remove_hidden_markers(*lines: str) -> Iterable[str]:
-    """Remove "//" markers and the following whitespace at the start of a line"""
-    for line in lines:
-        if line.strip().startswith("//"):
+    Both are built in one go, so a block is only processed once no matter how
+    many times its test or visible code is asked for."""
+    # Find hidden lines and the common indent in a single pass; a hidden
+    # marker counts towards the indent as though it were two spaces
+    hidden_lines = [False] * len(lines)
+    indent = None
+    for i, line in enumerate(lines):
+        hidden = _is_hidden(line)
+        hidden_lines[i] = hidden
+        if not line:
+            continue
+        line_indent = _LEADING_SPACES_RE.match(line).end()
+        if hidden and line.startswith("//", line_indent):
+            line_indent = _LEADING_SPACES_RE.match(line, line_indent + 2).end()
+        if indent is None or line_indent < indent:
+            indent = line_indent
+
+    indent = indent or 0
+    stripped_lines = [line[indent:] for line in lines]
+    for i, hidden in enumerate(hidden_lines):
+        line = stripped_lines[i]
+        if hidden and _is_hidden(line):
             before, _, after = line.partition("//")
-            line = before + after.lstrip()
-        yield line
+            stripped_lines[i] = before + after.lstrip()
+
+    visible_lines = [
+        line for line, hidden in zip(stripped_lines, hidden_lines) if not hidden
+    ]
+    visible_indent = get_common_indent(visible_lines)
+
+    exec_code = "\n".join(stripped_lines)
+    vis_code = "\n".join(line[visible_indent:] for line in visible_lines)
+    return exec_code, vis_code
+
+
+@functools.lru_cache(maxsize=4096)
+def _process_text(text: str) -> Tuple[str, str]:
+    """Cached version of _process_lines for the text of a literal block"""
+    return _process_lines(text.split("\n"))
 
 
 class PythonCode:
@@ -73,27 +116,22 @@ class PythonCode:
     hidden markers ("//") is removed. Then, any remaining hidden markers are removed,
     along with any whitespace between the hidden marker and the code."""
 
+    __slots__ = ("_raw", "_line_number", "_exec", "_vis")
+
     def __init__(
         self, text: Union[str, List[str], docutils.nodes.Node], lineno: int = 0
     ):
         if isinstance(text, str):
-            lines = text.splitlines()
-            if text.endswith("\n"):
-                lines.append("")
+            self._raw = text
+            self._exec, self._vis = _process_text(text)
         elif isinstance(text, list) and all(isinstance(s, str) for s in text):
-            lines: List[str] = text
+            self._raw = "\n".join(text)
+            self._exec, self._vis = _process_lines(text)
         else:
             raise ValueError("Text must be str or list of strs")
-        self._orig_lines = lines
 
         self._line_number = lineno
 
-        self._hidden_lines = [l.strip().startswith("//") for l in lines]
-
-        indent = get_common_indent(*whitespaceify_hidden_markers(*lines))
-        lines = [line[indent:] for line in lines]
-        self._lines = list(remove_hidden_markers(*lines))
-
     @classmethod
     def from_node(cls, node: docutils.nodes.literal_block) -> "PythonCode":
         if not isinstance(node, docutils.nodes.literal_block):
@@ -101,80 +139,96 @@ class PythonCode:
         if not node_lang_is_python(node):
             raise ValueError(f"Node {node} is not in the Python language")
 
-        return cls(node.astext(), node.line)
+        # Literal blocks usually hold a single Text node; read it directly
+        # rather than walking the subtree
+        children = node.children
+        if len(children) == 1 and isinstance(children[0], docutils.nodes.Text):
+            text = children[0].astext()
+        else:
+            text = node.astext()
+
+        return cls(text, node.line)
 
     def __str__(self) -> str:
-        return "\n".join(self._orig_lines)
+        return self._raw
 
     def __repr__(self) -> str:
-        return f"PythonCode('{self.__str__()}')"
+        return f"PythonCode('{self._raw}')"
 
     def to_exec(self) -> str:
         """Get the code that should be executed in a test"""
-        return "\n".join(self._lines)
+        return self._exec
 
     def to_vis(self) -> str:
-        hiddens = self._hidden_lines
-        lines = [line for line, hidden in zip(self._lines, hiddens) if not hidden]
-
-        common_indent = get_common_indent(*lines)
-        return "\n".join(l[common_indent:] for l in lines)
+        return self._vis
 
     @property
     def raw_source(self) -> str:
-        return "\n".join(self._orig_lines)
+        return self._raw
+
 
+def _findall(
+    node: docutils.nodes.Node, condition: type
+) -> Iterable[docutils.nodes.Node]:
+    """Iterate over the nodes in the tree under ``node`` that match ``condition``"""
+    # Node.findall was added in docutils 0.18, and Node.traverse deprecated
+    try:
+        findall = node.findall
+    except AttributeError:
+        findall = node.traverse
+    return findall(condition)
 
-class TestCollectionVisitor(docutils.nodes.SparseNodeVisitor):
-    def __init__(self, document):
-        self.tests: Dict[
-            int, str
-        ] = {}  # Maps line numbers to the tests that start there
-        self.document = document
 
-    def unknown_visit(self, node: docutils.nodes.Node):
-        pass
+class DoctestOxideTransform(SphinxTransform):
+    default_priority = 750
 
-    def visit_literal_block(self, node: docutils.nodes.literal_block):
-        if node_lang_is_python(node):
+    def apply(self, **kwargs: Any) -> None:
+        # Pairs of line numbers and the tests that start there
+        tests: List[Tuple[int, str]] = []
+
+        for node in _findall(self.document, docutils.nodes.literal_block):
+            if not node_lang_is_python(node):
+                continue
             content = PythonCode.from_node(node)
             new_content = content.to_vis()
-            assert len(node.children) == 1
-            node.replace(node.children[0], docutils.nodes.Text(new_content))
+            node[:] = [docutils.nodes.Text(new_content)]
             node.rawsource = new_content
-            self.tests[node.line] = content.to_exec()
+            tests.append((node.line, content.to_exec()))
 
+        # Documents without tests load as empty, so they need no file
+        if tests:
+            save_doctests(self.env, self.env.docname, tests)
 
-class DoctestOxideTransform(SphinxTransform):
-    default_priority = 750
 
-    def apply(self, **kwargs: Any) -> None:
-        visitor = TestCollectionVisitor(self.document)
-        self.document.walk(visitor)
-        docname = self.env.docname
-        self.env.doctest_oxide_data[docname] = visitor.tests
+def get_doctests_path(env: BuildEnvironment, docname: str) -> Path:
+    """Get the path of the file that stores the tests collected from a document
 
+    Tests are kept in files alongside the doctrees rather than on the build
+    environment, so they don't inflate the pickled environment and parallel
+    readers don't need to merge them back into it."""
+    return Path(env.doctreedir) / "doctest_oxide" / f"{docname}.pickle"
 
-def env_purge_doc_callback(app: Sphinx, env: BuildEnvironment, docname: str):
-    data = {}
-    try:
-        data = env.doctest_oxide_data
-    except AttributeError:
-        env.doctest_oxide_data = data
 
-    data[docname] = {}
+def save_doctests(env: BuildEnvironment, docname: str, tests: List[Tuple[int, str]]):
+    path = get_doctests_path(env, docname)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    data = pickle.dumps(tests, protocol=pickle.HIGHEST_PROTOCOL)
+    path.write_bytes(pickletools.optimize(data))
+
 
+def load_doctests(env: BuildEnvironment, docname: str) -> List[Tuple[int, str]]:
+    try:
+        data = get_doctests_path(env, docname).read_bytes()
+    except FileNotFoundError:
+        return []
+    return pickle.loads(data)
 
-def env_merge_info_callback(
-    app: Sphinx,
-    env: BuildEnvironment,
-    docnames: List[str],
-    other: BuildEnvironment,
-):
-    other_data = other.doctest_oxide_data
 
-    for docname in docnames:
-        env.doctest_oxide_data[docname] = other_data[docname]
+def env_purge_doc_callback(app: Sphinx, env: BuildEnvironment, docname: str):
+    try:
+        get_doctests_path(env, docname).unlink()
+    except FileNotFoundError:
+        pass
 
 
 def write_doctests_callback(app: Sphinx, exception: Optional[Exception]):
@@ -188,21 +242,53 @@ def write_doctests_callback(app: Sphinx, exception: Optional[Exception]):
     write_doctests(app, outdir=Path(app.env.srcdir) / "_doctests")
 
 
+_TEST_INDENT = b"    "
+
+
 def write_doctests(app: Sphinx, outdir: Path):
-    data = app.env.doctest_oxide_data
+    env = app.env
 
     outdir.mkdir(exist_ok=True)
+    paths = make_target_dirs(outdir, env.found_docs)
+
+    def write(docname: str, path: Path):
+        write_doctest_file(path, docname, load_doctests(env, docname))
+
+    # Writing the files is pure I/O, so threads can overlap it
+    with ThreadPoolExecutor() as executor:
+        futures = [executor.submit(write, *item) for item in paths.items()]
+        for future in futures:
+            future.result()
 
-    for docname, tests in data.items():
-        path = get_target_uri(outdir, docname)
-        path.parent.mkdir(parents=True, exist_ok=True)
-        if tests:
-            with path.open("w") as f:
-                for lineno, code in tests.items():
-                    f.write(f"def test_{slugify(docname)}_l{lineno}():\n")
-                    lines = ["    " + line for line in code.splitlines()]
-                    f.write("\n".join(lines))
-                    f.write("\n\n")
+
+def write_doctest_file(path: Path, docname: str, tests: List[Tuple[int, str]]):
+    """Write the tests collected from a document to the test file at path
+
+    The directory containing path must already exist; see make_target_dirs."""
+    if tests:
+        # Build the whole file in memory so it can be written in one go
+        buf = bytearray()
+        test_prefix = f"def test_{slugify(docname)}_l".encode()
+        for lineno, code in tests:
+            buf += test_prefix + f"{lineno}():\n".encode()
+            buf += b"\n".join(
+                _TEST_INDENT + line.encode() for line in code.splitlines()
+            )
+            buf += b"\n\n"
+        path.write_bytes(buf)
+
+
+def make_target_dirs(
+    outdir: Union[Path, str], docnames: Iterable[str]
+) -> Dict[str, Path]:
+    """Create the directories for the test files of docnames
+
+    Each directory is only created once, however many documents it holds.
+    Returns the path of each document's test file."""
+    paths = {docname: get_target_uri(outdir, docname) for docname in docnames}
+    for parent in {path.parent for path in paths.values()}:
+        parent.mkdir(parents=True, exist_ok=True)
+    return paths
 
 
 def get_target_uri(outdir: Union[Path, str], docname: str) -> Path:
@@ -225,10 +311,11 @@ class DoctestOxideBuilder(Builder):
         return "This builder always writes all doctests (for now)"
 
     def prepare_writing(self, docnames: Set[str]) -> None:
-        write_doctests(self.app, Path(self.outdir))
+        self._target_paths = make_target_dirs(self.outdir, docnames)
 
     def write_doc(self, docname: str, doctree: docutils.nodes.document) -> None:
-        pass
+        tests = load_doctests(self.env, docname)
+        write_doctest_file(self._target_paths[docname], docname, tests)
 
     def get_target_uri(self, docname: str, typ: str = None) -> str:
         return str(get_target_uri(self.outdir, docname))
@@ -245,14 +332,13 @@ def setup(app: Sphinx):
     app.add_transform(DoctestOxideTransform)
     app.add_builder(DoctestOxideBuilder)
     app.connect("env-purge-doc", env_purge_doc_callback)
-    app.connect("env-merge-info", env_merge_info_callback)
     app.connect("build-finished", write_doctests_callback)
 
     return {
         "version": "0.1",
         # The extensions have to increment the version when data structure has changed. If not given,
         # Sphinx considers the extension does not stores any data to environment.
-        "env_version": "1",
+        "env_version": "3",
         # A parallel_read_safe=True extension must satisfy the following conditions:
         #   - The core logic of the extension is parallelly executable during the reading phase.
         #   - It has event handlers for env-merge-info and env-purge-doc events if it stores data
@@ -4,6 +4,7 @@ Unit and regression test for the doctest_oxide package.
 
 # Import package, test suite, and other packages as needed
 import sys
+from types import SimpleNamespace
 
 import pytest
 
@@ -25,7 +26,7 @@ def test_leading_spaces():
 def test_get_common_indent():
     text = ["foo", "  bar", "baz", ""]
 
-    assert doctest_oxide.get_common_indent(*text) == 0
+    assert doctest_oxide.get_common_indent(text) == 0
 
     text = [
         "  foo",
@@ -33,7 +34,9 @@ def test_get_common_indent():
         "  baz",
     ]
 
-    assert doctest_oxide.get_common_indent(*text) == 2
+    assert doctest_oxide.get_common_indent(text) == 2
+
+    assert doctest_oxide.get_common_indent(["", ""]) == 0
 
 
 def test_pythoncode_1():
@@ -129,3 +132,104 @@ def test_pythoncode_3():
             "",
         ]
     )
+
+
+def test_pythoncode_whitespace_before_marker():
+    code = [
+        "// import foo",
+        "\t// foo.bar()",
+        "print(foo)",
+    ]
+
+    pcode = doctest_oxide.PythonCode(code)
+
+    assert pcode.to_exec() == "\n".join(
+        [
+            "import foo",
+            "\tfoo.bar()",
+            "print(foo)",
+        ]
+    )
+    assert pcode.to_vis() == "print(foo)"
+
+    code = [
+        "   //import foo",
+        "     foo.bar()",
+    ]
+
+    pcode = doctest_oxide.PythonCode(code)
+
+    assert pcode.to_exec() == "\n".join(
+        [
+            "import foo",
+            "foo.bar()",
+        ]
+    )
+    assert pcode.to_vis() == "foo.bar()"
+
+
+def test_pythoncode_raw_source():
+    text = "// import foo\nfoo.bar()\n"
+
+    pcode = doctest_oxide.PythonCode(text)
+    assert pcode.raw_source == text
+    assert str(pcode) == text
+
+    pcode = doctest_oxide.PythonCode(text.split("\n"))
+    assert pcode.raw_source == text
+    assert str(pcode) == text
+
+
+def test_write_doctest_file(tmp_path):
+    path = tmp_path / "test_page.py"
+    tests = [
+        (3, "import foo\nfor f in foo():\n    print(f)"),
+        (12, "x = 'é'"),
+    ]
+
+    doctest_oxide.write_doctest_file(path, "sub/My Page", tests)
+
+    assert path.read_bytes() == "\n".join(
+        [
+            "def test_submy_page_l3():",
+            "    import foo",
+            "    for f in foo():",
+            "        print(f)",
+            "",
+            "def test_submy_page_l12():",
+            "    x = 'é'",
+            "",
+            "",
+        ]
+    ).encode("utf-8")
+
+
+def test_write_doctest_file_no_tests(tmp_path):
+    path = tmp_path / "test_page.py"
+
+    doctest_oxide.write_doctest_file(path, "page", [])
+
+    assert not path.exists()
+
+
+def test_save_load_doctests(tmp_path):
+    env = SimpleNamespace(doctreedir=tmp_path)
+    tests = [(3, "import foo"), (12, "foo.bar()")]
+
+    assert doctest_oxide.load_doctests(env, "sub/page") == []
+
+    doctest_oxide.save_doctests(env, "sub/page", tests)
+    assert doctest_oxide.get_doctests_path(env, "sub/page").exists()
+    assert doctest_oxide.load_doctests(env, "sub/page") == tests
+
+
+def test_env_purge_doc_callback(tmp_path):
+    env = SimpleNamespace(doctreedir=tmp_path)
+    doctest_oxide.save_doctests(env, "page", [(3, "import foo")])
+
+    doctest_oxide.env_purge_doc_callback(None, env, "page")
+    assert not doctest_oxide.get_doctests_path(env, "page").exists()
+    assert doctest_oxide.load_doctests(env, "page") == []
+
+    # Purging a document whose file is already gone is fine
+    doctest_oxide.env_purge_doc_callback(None, env, "page")